@@ -88,11 +88,9 @@ ApplicationWindow {
 				}
 			}
 
-			Timer {
-				interval: 1 / 60 * 1000
-				running: true
-				repeat: true
-				onTriggered: {
+			Connections {
+				target: backend
+				function onSpectrumReady() {
 					backend.updateSpatialSpectrum(musicSpectrum, musicSpectrumYAxis)
 				}
 			}
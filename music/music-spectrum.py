@@ -4,17 +4,23 @@
 # 
 # @brief This file contains the implementation of the MUSIC-Algorithm for estimating the Direction-of-arrival (DoA)
 # of a signal impinging on an antenna array. The Data is received via a ZeroMQ socket and is processed in real-time.
-# The received Channel State Information (CSI) is formatted as a matrix with dimensions (size, n_boards, n_rows, n_antennas, subcarriers).
+# The received Channel State Information (CSI) messages have the dimensions (n_measurements, n_antennas, subcarriers). The latest
+# MAX_SNAPSHOTS measurements are kept in a ring buffer of two float32 arrays csi_re and csi_im (real and imaginary part),
+# each with the dimensions (n_antennas, MAX_SNAPSHOTS, subcarriers).
 # The MUSIC-Implementation is based on the ESPARGOS demo project https://github.com/ESPARGOS/pyespargos
 # @version 0.1
 # @date 2025-05-20
 
 import pathlib
 import sys
+import traceback
 
 sys.path.append(str(pathlib.Path(__file__).absolute().parents[2]))
 
+import numba
 import numpy as np
+import scipy.linalg
+import scipy.signal
 
 import PyQt6.QtWidgets
 import PyQt6.QtCharts
@@ -24,51 +30,208 @@ import zmq
 import struct
 
 ANTENNAS_PER_ROW = 2
+MAX_SNAPSHOTS = 64		# number of CSI measurements kept in the ring buffer
+RECEIVE_HWM = 16		# max. number of messages queued by the receiving zmq socket
+SIGNAL_COUNT = 1		# number of impinging signals (dimension of the signal subspace)
+ANGLE_TILE = 128		# number of scanning angles processed per tile by the spectrum kernel
+AXIS_HYSTERESIS = 0.5	# min. change of the spectrum minimum [dB] before the y-axis is updated
+COARSE_STEP = 10		# every COARSE_STEP-th scanning angle is evaluated in the coarse search
+REFINED_PEAKS = 2		# number of highest peaks of the coarse spectrum evaluated on the full grid
+
+@numba.njit("void(complex64[:, :], complex64[:, :], float32[::1])", cache=True, fastmath=True, parallel=True, nogil=True)
+def musicSpectrumKernel(Qn, S, out):
+	# fused noise subspace projection, squared norm and log for every scanning angle (column of S)
+	# the angle axis is processed in tiles of ANGLE_TILE columns, so the tile of S stays in L1 cache
+	# while the small conjugated noise subspace is reused for all angles of the tile
+	n_antennas, n_angles = S.shape
+	Qn_conj = np.conj(Qn)
+	n_tiles = (n_angles + ANGLE_TILE - 1) // ANGLE_TILE
+	for t in numba.prange(n_tiles):
+		for j in range(t * ANGLE_TILE, min((t + 1) * ANGLE_TILE, n_angles)):
+			acc = np.float32(0.0)
+			for e in range(Qn_conj.shape[1]):
+				z = np.complex64(0.0)
+				for a in range(n_antennas):
+					z += Qn_conj[a, e] * S[a, j]
+				acc += z.real * z.real + z.imag * z.imag
+			# 20 * log10(1 / sqrt(x)) = -10 * log10(x)
+			out[j] = -10.0 * np.log10(acc)
+
+@numba.njit("void(float32[::1], intp[::1], float32[::1])", cache=True, nogil=True)
+def interpolateSpectrum(coarse, coarse_index, out):
+	# linear interpolation of the coarse spectrum onto the full grid of scanning angles (in place)
+	for k in range(coarse_index.shape[0] - 1):
+		i0 = coarse_index[k]
+		i1 = coarse_index[k + 1]
+		slope = (coarse[k + 1] - coarse[k]) / (i1 - i0)
+		for i in range(i0, i1):
+			out[i] = coarse[k] + slope * (i - i0)
+	out[coarse_index[-1]] = coarse[-1]
+
+@numba.njit("UniTuple(float32, 2)(float32[::1])", cache=True)
+def spectrumRange(x):
+	# minimum and maximum of the spectrum in a single pass
+	x_min = x[0]
+	x_max = x[0]
+	for i in range(1, x.shape[0]):
+		if x[i] < x_min:
+			x_min = x[i]
+		elif x[i] > x_max:
+			x_max = x[i]
+	return x_min, x_max
+
+def noiseSubspace2x2(R):
+	# closed-form eigenvector of the smaller eigenvalue of the hermitian 2x2 matrix R = [[a, b], [conj(b), d]]
+	a = R[0, 0].real
+	d = R[1, 1].real
+	b = R[0, 1]
+	eig_val_min = 0.5 * (a + d) - np.hypot(0.5 * (a - d), abs(b))
+
+	# both rows of (R - eig_val_min * I) yield the eigenvector, use the better conditioned one
+	if abs(a - eig_val_min) >= abs(d - eig_val_min):
+		eig_vec = np.array([[-b], [a - eig_val_min]], dtype=R.dtype)
+	else:
+		eig_vec = np.array([[eig_val_min - d], [np.conj(b)]], dtype=R.dtype)
+
+	norm = np.linalg.norm(eig_vec)
+	if norm == 0:
+		# R is a multiple of the identity, every vector is an eigenvector
+		return np.array([[1], [0]], dtype=R.dtype)
+	eig_vec /= norm
+	return eig_vec
+
+class SpectrumWorker(PyQt6.QtCore.QThread):
+	resultReady = PyQt6.QtCore.pyqtSignal()
+
+	def __init__(self, compute):
+		super().__init__()
+		self.compute = compute
+		self.mutex = PyQt6.QtCore.QMutex()
+		self.condition = PyQt6.QtCore.QWaitCondition()
+		self.pending = False
+		self.running = True
+
+	def notify(self):
+		# request a new computation (multiple requests before the next run are merged)
+		with PyQt6.QtCore.QMutexLocker(self.mutex):
+			self.pending = True
+			self.condition.wakeOne()
+
+	def stop(self):
+		with PyQt6.QtCore.QMutexLocker(self.mutex):
+			self.running = False
+			self.condition.wakeOne()
+		self.wait()
+
+	def run(self):
+		while True:
+			self.mutex.lock()
+			while self.running and not self.pending:
+				self.condition.wait(self.mutex)
+			running = self.running
+			self.pending = False
+			self.mutex.unlock()
+
+			if not running:
+				return
+
+			# an exception would abort the whole application from within QThread.run, skip the update instead
+			try:
+				updated = self.compute()
+			except Exception:
+				traceback.print_exc()
+				continue
+			if updated:
+				self.resultReady.emit()
 
 class MusicSpectrum(PyQt6.QtWidgets.QApplication):
+	spectrumReady = PyQt6.QtCore.pyqtSignal()
+
 	def pollSocket(self):
-     	# Drain the socket: collect all messages 
-		messages = []
+		# Drain the socket: collect all messages as zmq frames (no copy of the payload)
+		frames = []
 		while True:
 			try:
-				msg = self.socket.recv(zmq.NOBLOCK)
-				messages.append(msg)
+				frame = self.socket.recv(zmq.NOBLOCK, copy=False)
+				frames.append(frame)
 			except zmq.Again:
 				break  # No more messages available
 
-		#process messages 
-		all_data = []
-		for msg in messages:
+		if not frames:
+			return
+
+		# process messages and copy them straight into the ring buffer (shared with the worker thread)
+		with PyQt6.QtCore.QMutexLocker(self.csi_mutex):
+			for frame in frames:
+				buf = frame.buffer
+
 				# Header: 3 x uint32 → 12 bytes
-				n_measurements, num_channels, samples_per_channel = struct.unpack("III", msg[:12])
+				n_measurements, num_channels, samples_per_channel = struct.unpack_from("III", buf, 0)
 				
-    			# Load Data (complex values)
-				data = np.frombuffer(msg[12:], dtype=np.complex64)
-    
-				# Transform to  (num_channels, samples_per_channel) 
+				# Load Data (complex values) as a view on the frame buffer
+				# and transform to (n_measurements, num_channels, samples_per_channel) 
 				try:
+					data = np.frombuffer(buf, dtype=np.complex64, offset=12, count=n_measurements * num_channels * samples_per_channel)
 					reshaped = data.reshape((n_measurements, num_channels, samples_per_channel))
 				except ValueError:
-					return  # skip invalid reshape
- 
-				all_data.append(reshaped)  
-  
+					continue  # skip message shorter than announced in the header
 
-		if not all_data:
-			return
-      
-		# stack along n_measurements axis
-		stacked = np.concatenate(all_data, axis=0)
-      
-		# shape : (size, n_arrays, n_rows, n_antennas, subcarriers)
-		self.csi = stacked[:, np.newaxis, np.newaxis, :, :]
+				# (re-)allocate the ring buffer if the dimensions of the CSI changed
+				if self.csi_re is None or self.csi_re.shape != (num_channels, MAX_SNAPSHOTS, samples_per_channel):
+					self.resetRingBuffer(num_channels, samples_per_channel)
+
+				self.writeRingBuffer(reshaped)
    
-		# modify steering vectors
-		if num_channels != self.antennas_per_row:
-			self.antennas_per_row = num_channels
-			self.steering_vectors = np.exp(-1.0j * np.outer(np.pi * np.sin(self.scanning_angles), np.arange(self.antennas_per_row)))
+				# modify steering vectors
+				if num_channels != self.antennas_per_row:
+					self.updateSteeringVectors(num_channels)
+
+		# wake up the worker thread to compute the spectrum for the new CSI
+		self.worker.notify()
+
+	def updateSteeringVectors(self, n_antennas):
+		# steering vectors are the phases of the received Signal as function of angle theta 
+		self.antennas_per_row = n_antennas
+		phase = np.multiply.outer(self.scanning_phases, np.arange(n_antennas, dtype=np.float32))
+		self.steering_vectors = np.exp(-1.0j * phase).astype(np.complex64, copy=False)
+		# transposed steering vectors (n_antennas x n_angles) for the noise subspace projection
+		self.S = np.ascontiguousarray(self.steering_vectors.T)
+		self.S_coarse = np.ascontiguousarray(self.S[:, self.coarse_index])
+
+	def resetRingBuffer(self, num_channels, samples_per_channel):
+		# real and imaginary part are stored separately (float32) for SIMD-friendly BLAS reductions
+		# shape : (n_antennas, MAX_SNAPSHOTS, subcarriers), zero-initialized so empty slots do not contribute to R
+		self.csi_re = np.zeros((num_channels, MAX_SNAPSHOTS, samples_per_channel), dtype=np.float32)
+		self.csi_im = np.zeros((num_channels, MAX_SNAPSHOTS, samples_per_channel), dtype=np.float32)
+		self.ring_index = 0
+		self.ring_filled = 0
+
+		# scratch buffers for the covariance matrix, reused for every spectrum update
+		self.R = np.empty((num_channels, num_channels), dtype=np.complex64)
+		self.R_re = np.empty((num_channels, num_channels), dtype=np.float32)
+		self.R_im = np.empty((num_channels, num_channels), dtype=np.float32)
+		self.R_tmp = np.empty((num_channels, num_channels), dtype=np.float32)
+
+	def writeRingBuffer(self, data):
+		# only the newest MAX_SNAPSHOTS measurements are kept, older ones are overwritten in place
+		# data : (n_measurements, n_antennas, subcarriers) -> antenna-major layout of the ring buffer
+		data = data[-MAX_SNAPSHOTS:].transpose(1, 0, 2)
+		n_measurements = data.shape[1]
+		end = self.ring_index + n_measurements
+
+		if end <= MAX_SNAPSHOTS:
+			self.csi_re[:, self.ring_index:end] = data.real
+			self.csi_im[:, self.ring_index:end] = data.imag
+		else:
+			split = MAX_SNAPSHOTS - self.ring_index
+			self.csi_re[:, self.ring_index:] = data.real[:, :split]
+			self.csi_im[:, self.ring_index:] = data.imag[:, :split]
+			self.csi_re[:, :end - MAX_SNAPSHOTS] = data.real[:, split:]
+			self.csi_im[:, :end - MAX_SNAPSHOTS] = data.imag[:, split:]
+
+		self.ring_index = end % MAX_SNAPSHOTS
+		self.ring_filled = min(self.ring_filled + n_measurements, MAX_SNAPSHOTS)
 
-		
 	def __init__(self, argv):
 		super().__init__(argv)
 
@@ -79,17 +242,45 @@ class MusicSpectrum(PyQt6.QtWidgets.QApplication):
 		# ZMQ socket setup
 		context = zmq.Context()
 		self.socket = context.socket(zmq.PULL)
+		# bound the receive queue: once it is full, the blocking ZmqSender is pushed back instead of
+		# the receiver buffering an arbitrary backlog (old CSI is only discarded by the ring buffer)
+		self.socket.setsockopt(zmq.RCVHWM, RECEIVE_HWM)
+		self.socket.setsockopt(zmq.LINGER, 0)
+		self.socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
 		self.socket.connect("tcp://localhost:5555")
 		self.poller = zmq.Poller()
 		self.poller.register(self.socket, zmq.POLLIN)
-		self.csi = None
-		self.antennas_per_row = ANTENNAS_PER_ROW
+
+		# Ring buffer for the latest CSI measurements, allocated on the first message
+		self.csi_re = None
+		self.csi_im = None
+		self.ring_index = 0
+		self.ring_filled = 0
+		self.csi_mutex = PyQt6.QtCore.QMutex()
 
 		# Initialize MUSIC scanning angles, steering vectors
-   		# steering vectors are the phases of the received Signal as function of angle theta 
+		# the phase difference between adjacent antennas pi * sin(theta) is computed only once
 		self.scanning_angles = np.linspace(-np.pi / 2, np.pi / 2, 1800) 
-		self.steering_vectors = np.exp(-1.0j * np.outer(np.pi * np.sin(self.scanning_angles), np.arange(self.antennas_per_row)))
-		self.spatial_spectrum = None
+		self.scanning_phases = (np.pi * np.sin(self.scanning_angles)).astype(np.float32)
+		# points of the displayed spectrum (x-axis in degrees), allocated once and updated in place
+		self.spectrum_points = [PyQt6.QtCore.QPointF(angle, 0.0) for angle in np.rad2deg(self.scanning_angles).tolist()]
+		# indices of the scanning angles of the coarse search (including both ends of the grid)
+		self.scanning_index = np.arange(len(self.scanning_angles), dtype=np.intp)
+		self.coarse_index = np.unique(np.append(self.scanning_index[::COARSE_STEP], self.scanning_index[-1]))
+		self.coarse_spectrum = np.empty(len(self.coarse_index), dtype=np.float32)
+		self.updateSteeringVectors(ANTENNAS_PER_ROW)
+		# output buffer of the spectrum kernel [dB], reused for every update
+		self.spatial_spectrum = np.empty(len(self.scanning_angles), dtype=np.float32)
+		self.spectrum_updated = False
+		self.spectrum_mutex = PyQt6.QtCore.QMutex()
+		# current range of the y-axis [dB]
+		self.axis_min = None
+		self.axis_max = None
+
+		# Compute the spectrum in a separate thread, the GUI is redrawn whenever a new spectrum is ready
+		self.worker = SpectrumWorker(self.computeSpatialSpectrum)
+		self.worker.resultReady.connect(self.spectrumReady)
+		self.worker.start()
 
 		# Poll CSI from socket
 		self.timer = PyQt6.QtCore.QTimer()
@@ -108,35 +299,88 @@ class MusicSpectrum(PyQt6.QtWidgets.QApplication):
 
 		return super().exec()
 
-	@PyQt6.QtCore.pyqtSlot(PyQt6.QtCharts.QLineSeries, PyQt6.QtCharts.QValueAxis)
-	def updateSpatialSpectrum(self, series, axis):
-		if self.csi is None:
-			return
+	def computeSpatialSpectrum(self):
+		# executed by the worker thread, returns False if there is no CSI yet
+		with PyQt6.QtCore.QMutexLocker(self.csi_mutex):
+			if self.ring_filled == 0:
+				return False
 
-		# compute the covariance matrix (complex inner product between indices i and j (n_antennas axis))
-  		# R_ij = sum_d sum_b sum_r sum_s CSI[d,b,r,i,s] * conj( CSI[d,b,r,j,s] )
-		R = np.einsum("dbris,dbrjs->ij", self.csi, np.conj(self.csi))
-  
-		# eigenvalue decomposition
-		eig_val, eig_vec = np.linalg.eig(R)
-  
-		# sort eigenvalues and eigenvectors in decreasing order
-		order = np.argsort(eig_val)[::-1]
+			# a noise subspace only exists if there are more antennas than signals
+			n_antennas = self.csi_re.shape[0]
+			if n_antennas <= SIGNAL_COUNT:
+				return False
+
+			# compute the covariance matrix (complex inner product between indices i and j (n_antennas axis))
+			# R_ij = sum_d sum_s CSI[i,d,s] * conj( CSI[j,d,s] )
+			# collapsing the snapshot and subcarrier axes gives R = X @ X^H with X = re + j*im, which is
+			# evaluated by real single precision BLAS gemms: re(R) = re @ re^T + im @ im^T, im(R) = im @ re^T - re @ im^T
+			re = self.csi_re.reshape(n_antennas, -1)
+			im = self.csi_im.reshape(n_antennas, -1)
+			R = self.R
+			np.matmul(re, re.T, out=self.R_re)
+			np.matmul(im, im.T, out=self.R_tmp)
+			np.add(self.R_re, self.R_tmp, out=self.R_re)
+			np.matmul(im, re.T, out=self.R_tmp)
+			np.subtract(self.R_tmp, self.R_tmp.T, out=self.R_im)
+			R.real = self.R_re
+			R.imag = self.R_im
+			S = self.S
+			S_coarse = self.S_coarse
   
-		# ignore the eigenvector of the largest eigenvalue => noise subspace
-		Qn = eig_vec[:,order][:,1:]
+		# eigenvalue decomposition of the hermitian covariance matrix (eigenvalues in ascending order)
+		# ignore the eigenvectors of the SIGNAL_COUNT largest eigenvalues => noise subspace
+		# only the noise subspace is computed, R is complex64, so LAPACK cheevr is used in single precision
+		if n_antennas == 2 and SIGNAL_COUNT == 1:
+			Qn = noiseSubspace2x2(R)
+		else:
+			# Qn is passed to the kernel as returned by LAPACK (Fortran order), without slicing or copying
+			eig_val, Qn = scipy.linalg.eigh(R, subset_by_index=[0, n_antennas - SIGNAL_COUNT - 1], check_finite=False, overwrite_a=True, driver="evr")
   
-		# compute the spatial spectrum
-		spatial_spectrum_linear = 1 / np.linalg.norm(np.einsum("ae,ra->er", np.conj(Qn), self.steering_vectors), axis = 0)
-		spatial_spectrum_log = 20 * np.log10(spatial_spectrum_linear)
+		# compute the spatial spectrum (squared norm and log fused in a single pass)
+		# coarse search on a subset of the scanning angles to locate the peaks of the spectrum
+		musicSpectrumKernel(Qn, S_coarse, self.coarse_spectrum)
+		# padding with -inf lets find_peaks also report maxima at both ends of the grid (sources close to +-90 deg)
+		peaks, properties = scipy.signal.find_peaks(np.pad(self.coarse_spectrum, 1, constant_values=-np.inf), height=-np.inf)
+		peaks = peaks[np.argsort(properties["peak_heights"])[::-1][:REFINED_PEAKS]] - 1
+
+		with PyQt6.QtCore.QMutexLocker(self.spectrum_mutex):
+			# interpolate the coarse spectrum and evaluate the full grid around the peaks
+			interpolateSpectrum(self.coarse_spectrum, self.coarse_index, self.spatial_spectrum)
+			for peak in self.coarse_index[peaks]:
+				start = max(peak - COARSE_STEP, 0)
+				stop = min(peak + COARSE_STEP + 1, len(self.spatial_spectrum))
+				musicSpectrumKernel(Qn, S[:, start:stop], self.spatial_spectrum[start:stop])
+			self.spectrum_updated = True
+		return True
+
+	@PyQt6.QtCore.pyqtSlot(PyQt6.QtCharts.QLineSeries, PyQt6.QtCharts.QValueAxis)
+	def updateSpatialSpectrum(self, series, axis):
+		# take the latest spectrum computed by the worker thread
+		with PyQt6.QtCore.QMutexLocker(self.spectrum_mutex):
+			if not self.spectrum_updated:
+				return
+			self.spectrum_updated = False
+			spectrum_min, spectrum_max = spectrumRange(self.spatial_spectrum)
+			# convert to python floats in one call instead of unboxing numpy scalars per point
+			spatial_spectrum_log = self.spatial_spectrum.tolist()
 
-		axis.setMin(np.min(spatial_spectrum_log) - 1)
-		axis.setMax(max(np.max(spatial_spectrum_log), axis.max()))
+		# update the y-axis only if the range of the spectrum changed noticeably (avoids Qt property round-trips)
+		if self.axis_max is None:
+			self.axis_max = axis.max()
+		if self.axis_min is None or abs(spectrum_min - 1 - self.axis_min) > AXIS_HYSTERESIS:
+			self.axis_min = spectrum_min - 1
+			axis.setMin(self.axis_min)
+		if spectrum_max > self.axis_max:
+			self.axis_max = spectrum_max
+			axis.setMax(self.axis_max)
 
-		data = [PyQt6.QtCore.QPointF(np.rad2deg(angle), power) for angle, power in zip(self.scanning_angles, spatial_spectrum_log)]
-		series.replace(data)
+		# update the preallocated points in place instead of constructing new QPointF objects
+		for point, power in zip(self.spectrum_points, spatial_spectrum_log):
+			point.setY(power)
+		series.replace(self.spectrum_points)
 
 	def onAboutToQuit(self):
+		self.worker.stop()
 		self.engine.deleteLater()
 
 	@PyQt6.QtCore.pyqtProperty(list, constant=True)
@@ -6,6 +6,8 @@ setup(
     install_requires=[
         "websockets>=12.0",
 		"numpy>=1.26.0",
+        "scipy>=1.11.0",
+        "numba>=0.59.0",
         "PyQt6>=6.5.0",
         "PyQt6-Charts>=6.9.0",
         "pyzmq"
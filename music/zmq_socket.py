@@ -14,16 +14,18 @@ socket = context.socket(zmq.PULL)
 socket.connect("tcp://localhost:5555")
 
 while True:
-    msg = socket.recv()
+    # Receive as zmq frame to access the payload without copying it
+    frame = socket.recv(copy=False)
+    buf = frame.buffer
 
-    # Header: 2 x uint32 → 8 bytes
-    num_channels, samples_per_channel = struct.unpack("II", msg[:8])
+    # Header: 3 x uint32 → 12 bytes
+    n_measurements, num_channels, samples_per_channel = struct.unpack_from("III", buf, 0)
 
     # Data: complex values
-    data = np.frombuffer(msg[8:], dtype=np.complex64)
+    data = np.frombuffer(buf, dtype=np.complex64, offset=12, count=n_measurements * num_channels * samples_per_channel)
 
-    # Transform to  (num_channels, samples_per_channel) 
-    reshaped = data.reshape((num_channels, samples_per_channel))
+    # Transform to  (n_measurements, num_channels, samples_per_channel) 
+    reshaped = data.reshape((n_measurements, num_channels, samples_per_channel))
 
-    print(f"Received: {num_channels} \t Samples per Channel:{samples_per_channel}")
+    print(f"Received: {n_measurements} \t Channels: {num_channels} \t Samples per Channel:{samples_per_channel}")
     print(reshaped)